@@ -1,128 +1,181 @@
 import os
+import re
+from pathlib import Path
+import string
 import gradio as gr
-from llama_cpp import Llama
-from typing import List, Dict
+from typing import List, Dict, Iterator, Tuple
+import codecs
 import subprocess
+import tempfile
 import json
 import sys
+import bisect
+import itertools
+import threading
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 
-# Custom CSS for styling
-custom_css = """
-:root {
-    --primary-color: #4a90e2;
-    --secondary-color: #2c3e50;
-    --accent-color: #e74c3c;
-    --background-color: #f5f6fa;
-    --text-color: #2c3e50;
-    --border-color: #dcdde1;
+# Approximate bytes per weight for common GGUF quantizations, fastest first.
+# CPU decoding reads every weight once per token, so fewer bytes means faster replies.
+QUANT_BYTES_PER_PARAM = {
+    "Q4_K_4": 0.5625,
+    "Q4_0": 0.5625,
+    "Q4_K_M": 0.6055,
+    "Q5_K_M": 0.7109,
+    "Q8R16": 1.0625,
+    "Q8_0": 1.0625,
+    "F16": 2.0,
+    "BF16": 2.0,
 }
+QUANT_PATTERN = re.compile(r"(?<![A-Za-z0-9])(Q4_K_4|Q8R16|Q\d[_A-Za-z0-9]*|BF16|F16)", re.IGNORECASE)
 
-.gradio-container {
-    background: var(--background-color) !important;
-    font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif !important;
-}
-
-/* Title container styling */
-.title-container {
-    background: linear-gradient(135deg, var(--primary-color), var(--secondary-color)) !important;
-    padding: 2rem !important;
-    border-radius: 10px !important;
-    margin-bottom: 2rem !important;
-    box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1) !important;
-    text-align: center !important;
-}
+def parse_quant(file: str) -> str:
+    """Return the quantization suffix of a GGUF filename (e.g. Q4_K_M), or an empty string"""
+    match = QUANT_PATTERN.search(os.path.splitext(file)[0])
+    return match.group(1).upper() if match else ""
 
-.title-container h1 {
-    color: white !important;
-    font-size: 2.5rem !important;
-    margin: 0 !important;
-    text-shadow: 2px 2px 4px rgba(0, 0, 0, 0.3) !important;
-}
+TURN_TEMPLATE = string.Template("<|$role|>\n$content\n</|$role|>\n")
 
-.title-container h2 {
-    color: rgba(255, 255, 255, 0.9) !important;
-    margin: 0.5rem 0 0 0 !important;
-    text-shadow: 1px 1px 2px rgba(0, 0, 0, 0.2) !important;
-}
-
-.title-container p {
-    color: rgba(255, 255, 255, 0.9) !important;
-    margin: 0.5rem 0 0 0 !important;
-    text-shadow: 1px 1px 2px rgba(0, 0, 0, 0.2) !important;
-}
-
-.gradio-interface {
-    max-width: 1200px !important;
-    margin: 0 auto !important;
-    padding: 2rem !important;
-}
-
-.gradio-row {
-    background: white !important;
-    border-radius: 10px !important;
-    padding: 1.5rem !important;
-    margin-bottom: 1.5rem !important;
-    box-shadow: 0 2px 4px rgba(0, 0, 0, 0.05) !important;
-}
-
-.gradio-button {
-    background: var(--primary-color) !important;
-    color: white !important;
-    border: none !important;
-    padding: 0.75rem 1.5rem !important;
-    border-radius: 5px !important;
-    font-weight: 600 !important;
-    transition: all 0.3s ease !important;
-}
+def format_turns(turns: Tuple[Tuple[str, str], ...]) -> str:
+    """Render (role, content) turns with the chat template"""
+    return "".join(TURN_TEMPLATE.substitute(role=role, content=content) for role, content in turns)
 
-.gradio-button:hover {
-    background: var(--secondary-color) !important;
-    transform: translateY(-2px) !important;
-}
+def llama_params() -> Dict:
+    """Llama constructor arguments, overridable from the environment to match the host hardware"""
+    return {
+        "n_ctx": int(os.getenv("N_CTX", 4096)),
+        "n_threads": int(os.getenv("N_THREADS", os.cpu_count())),
+        "n_threads_batch": os.cpu_count(),
+        # Prefill a whole turn in one sweep so each weight read is reused across many tokens
+        "n_batch": int(os.getenv("N_BATCH", 1024)),
+        "n_ubatch": int(os.getenv("N_BATCH", 1024)),
+        "n_gpu_layers": int(os.getenv("NGL", 0)),
+        "use_mmap": True,
+        "use_mlock": bool(int(os.getenv("MLOCK", "0"))),
+    }
 
-.gradio-textbox {
-    border: 2px solid var(--border-color) !important;
-    border-radius: 5px !important;
-    padding: 1rem !important;
-    font-size: 1rem !important;
-    color: var(--text-color) !important;
-    background: white !important;
-}
+# End-of-turn tokens llama.cpp treats as end of generation besides EOS
+END_OF_TURN_TEXTS = [
+    "<end_of_turn>", "<|eot_id|>", "<|im_end|>", "<|end|>", "<|endoftext|>",
+    "<|end_of_text|>", "<EOT>", "<|return|>", "<|call|>",
+]
 
-.gradio-textbox:focus {
-    border-color: var(--primary-color) !important;
-    box-shadow: 0 0 0 2px rgba(74, 144, 226, 0.2) !important;
-}
+def end_of_generation_tokens(model) -> frozenset:
+    """Token ids that end a reply: EOS, any EOT/EOM ids in the GGUF metadata and special end-of-turn tokens"""
+    tokens = {model.token_eos()}
+    for key in ("tokenizer.ggml.eos_token_id", "tokenizer.ggml.eot_token_id", "tokenizer.ggml.eom_token_id"):
+        if key in model.metadata:
+            tokens.add(int(model.metadata[key]))
+    for text in END_OF_TURN_TEXTS:
+        # A special token parses to one id with special=True but is plain text otherwise
+        special = model.tokenize(text.encode("utf-8"), add_bos=False, special=True)
+        if len(special) == 1 and len(model.tokenize(text.encode("utf-8"), add_bos=False, special=False)) > 1:
+            tokens.add(special[0])
+    return frozenset(tokens)
 
-.gradio-dropdown {
-    border: 2px solid var(--border-color) !important;
-    border-radius: 5px !important;
-    padding: 0.5rem !important;
-    color: var(--text-color) !important;
-    background: white !important;
-}
+# Small models that can draft tokens for speculative decoding
+DRAFT_PATTERN = re.compile(r"(?<![\d.])1B(?![A-Za-z0-9])|draft", re.IGNORECASE)
 
-.gradio-dropdown option {
-    color: var(--text-color) !important;
-    background: white !important;
-}
+class DraftModel:
+    """Propose tokens with a small GGUF model for speculative decoding.
+    
+    Llama.generate calls this with the tokens so far and verifies all the
+    proposals in a single forward pass of the large model.
+    """
+    def __init__(self, model, n_draft: int = 5):
+        self.model = model
+        self.n_draft = n_draft
+        self._lock = threading.Lock()  # Large models generating concurrently share this draft
+    
+    def __call__(self, input_ids, **kwargs):
+        import numpy as np
+        draft = []
+        with self._lock:
+            # generate() reuses the draft's KV cache for the longest matching prefix
+            for token in self.model.generate(input_ids.tolist(), temp=0.0, reset=True):
+                draft.append(token)
+                if len(draft) >= self.n_draft:
+                    break
+        return np.array(draft, dtype=np.intc)
 
-.gradio-footer {
-    text-align: center !important;
-    padding: 1rem !important;
-    color: var(--text-color) !important;
-    font-size: 0.9rem !important;
-    margin-top: 2rem !important;
-}
-"""
+class BinScheduler:
+    """Admit one generation at a time, serving waiting requests shortest bin first.
+    
+    Requests are bucketed by prompt length as a cheap predictor of their
+    execution time; FIFO order is kept within a bin. A request passed over
+    by max_passes admissions is aged to the front so it cannot starve.
+    """
+    def __init__(self, bin_edges=(64, 256, 1024), max_passes: int = 2):
+        self.bin_edges = bin_edges
+        self.max_passes = max_passes
+        self._cond = threading.Condition()
+        self._busy = False
+        self._waiting = []  # (bin, arrival, admissions at arrival) tickets
+        self._arrivals = itertools.count()
+        self._admissions = 0
+    
+    def bin_of(self, prompt: str) -> int:
+        """Predict the bin of a request from its prompt length"""
+        return bisect.bisect(self.bin_edges, len(prompt))
+    
+    def _priority(self, ticket):
+        bin_, arrival, admitted_before = ticket
+        if self._admissions - admitted_before >= self.max_passes:
+            # Aged: served oldest first, ahead of every bin
+            return (0, 0, arrival)
+        return (1, bin_, arrival)
+    
+    @contextmanager
+    def slot(self, prompt: str = ""):
+        """Block until this request is the best waiting one and the model is free"""
+        with self._cond:
+            ticket = (self.bin_of(prompt), next(self._arrivals), self._admissions)
+            self._waiting.append(ticket)
+            while self._busy or min(self._waiting, key=self._priority) != ticket:
+                self._cond.wait()
+            self._waiting.remove(ticket)
+            self._admissions += 1
+            self._busy = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._busy = False
+                self._cond.notify_all()
 
 class InstaLLM:
     def __init__(self, models_dir: str = "models"):
         self.models_dir = models_dir
-        self.models: Dict[str, Llama] = {}
+        self.models: Dict[str, Dict] = {}
         self.available_models = []
         self.conversation_history: Dict[str, List[Dict[str, str]]] = {}
         self.bitnet_models = {}  # Store BitNet model paths
+        self.model_paths: Dict[str, str] = {}  # Resolved path of every model, filled by the scan
+        self._models_mtime = None  # models_dir mtime at the last scan
+        self._models_cache: List[str] = []  # Dropdown choices from the last scan
+        self.draft_candidates: List[str] = []  # Small models usable as speculative drafts
+        self.draft_models: Dict[str, DraftModel] = {}  # Draft attached to each large model
+        self._draft = None  # Shared DraftModel, loaded with the first large model that matches it
+        self._draft_vocab = None  # (n_vocab, BOS, EOS) of the draft candidate, from a vocab-only load
+        self._draft_lock = threading.Lock()
+        self._Llama = None  # llama_cpp.Llama, imported on first model load
+        self._bitnet_backend = None  # Llama class from the BitNet-enabled llama-cpp-python build
+        self.kv_state = {}  # llama.cpp session state saved after each turn
+        self.max_new_tokens = 2000  # Reply length cap, further clamped to the free context
+        self.max_history_tokens = 1500  # History budget for the BitNet CLI, counted in words
+        self.summary_every = 4  # Evicted messages needed before refreshing the summary
+        self.summary_tokens = 160  # Context reserved for the summary block
+        self.summary: Dict[str, str] = {}  # Running summary of evicted turns
+        self._evicted: Dict[str, List[Dict[str, str]]] = {}  # Evicted turns not yet summarized
+        self.system_tokens: Dict[str, List[int]] = {}  # Tokenized system block per model
+        self.eog_tokens: Dict[str, frozenset] = {}  # Token ids that end a reply, per model
+        self.turn_overhead: Dict[str, Dict[str, int]] = {}  # Role tag tokens per turn, per model
+        self._rendered: Dict[str, Tuple[Tuple[Tuple[str, str], ...], str]] = {}  # Last (turns, text) per model
+        self.primed_state = {}  # llama.cpp state with only the system block evaluated
+        self._models_lock = threading.Lock()  # Guards self.models against the preload thread
+        self._bg = ThreadPoolExecutor(max_workers=1)
+        self._preloads: Dict[str, Future] = {}
+        self._schedulers: Dict[str, BinScheduler] = {}  # Serializes access to each Llama instance
         
         # Create models directory if it doesn't exist
         if not os.path.exists(models_dir):
@@ -140,25 +193,162 @@ Your responses should be:
 4. Well-structured and easy to read
 
 Always maintain a helpful and professional tone. If you're unsure about something, say so rather than making things up."""
+        
+        # Warm models in the background while the user is still choosing. Each preloaded
+        # model keeps its own KV cache and has its weights paged in by the system prompt
+        # prefill, so by default only the dropdown default is preloaded
+        preload = os.getenv("PRELOAD", "default").lower()
+        if preload == "all":
+            preload_models = self._models_cache
+        elif preload == "default":
+            preload_models = self._models_cache[:1]
+        else:
+            preload_models = []
+        for model_name in preload_models:
+            self._preloads[model_name] = self._bg.submit(self._preload, model_name)
     
     def _load_available_models(self):
         """Load all .gguf files from the models directory"""
-        self.available_models = []
-        self.bitnet_models = {}
+        # The listing only changes when the directory does, so skip the rescan otherwise
+        models_mtime = os.stat(self.models_dir).st_mtime_ns
+        if models_mtime == self._models_mtime:
+            return self._models_cache
         
-        for file in os.listdir(self.models_dir):
-            if file.endswith(".gguf"):
-                # Check if it's a BitNet model
-                if "ggml" in file.lower():
-                    self.bitnet_models[file] = os.path.join(self.models_dir, file)
-                else:
-                    self.available_models.append(file)
+        available_models = []
+        bitnet_models = {}
+        model_paths: Dict[str, str] = {}
+        with os.scandir(self.models_dir) as entries:
+            for entry in entries:
+                # One stat per file here instead of a join and exists check on every load
+                if entry.name.endswith(".gguf") and entry.is_file():
+                    model_paths[entry.name] = str(Path(self.models_dir) / entry.name)
+                    # Check if it's a BitNet model
+                    if "ggml" in entry.name.lower():
+                        bitnet_models[entry.name] = model_paths[entry.name]
+                    else:
+                        available_models.append(entry.name)
+        
+        # Surface the quantization with the least weight traffic first
+        quant_rank = list(QUANT_BYTES_PER_PARAM)
+        available_models.sort(
+            key=lambda f: quant_rank.index(parse_quant(f)) if parse_quant(f) in quant_rank else len(quant_rank)
+        )
+        self.available_models = available_models
+        self.bitnet_models = bitnet_models
+        self.model_paths = model_paths
+        # Prefer explicit draft models, then the fastest quantization
+        self.draft_candidates = sorted(
+            (f for f in available_models if DRAFT_PATTERN.search(f)),
+            key=lambda f: "draft" not in f.lower()
+        )
         
         print(f"Available models: {self.available_models}")
         print(f"Available BitNet models: {list(self.bitnet_models.keys())}")
         
         # Return all available models for the dropdown
-        return self.available_models + list(self.bitnet_models.keys())
+        self._models_mtime = models_mtime
+        self._models_cache = self.available_models + list(self.bitnet_models.keys())
+        return self._models_cache
+    
+    def _llama_class(self):
+        """Import llama_cpp on first use so it stays out of the app's cold start"""
+        if self._Llama is None:
+            from llama_cpp import Llama
+            self._Llama = Llama
+        return self._Llama
+    
+    def _vocab_signature(self, model_path: str) -> Tuple[int, int, int]:
+        """Vocabulary size and BOS/EOS ids of a GGUF, from a load that reads just the tokenizer"""
+        vocab = self._llama_class()(model_path=model_path, vocab_only=True, verbose=False)
+        return vocab.n_vocab(), vocab.token_bos(), vocab.token_eos()
+    
+    def _draft_for(self, model_path: str):
+        """Return the shared draft model if its vocabulary matches the model at model_path, else None"""
+        draft_name = self.draft_candidates[0]
+        try:
+            with self._draft_lock:
+                if self._draft_vocab is None:
+                    self._draft_vocab = self._vocab_signature(self.model_paths[draft_name])
+                # Drafts only help when both models share a vocabulary, so the full draft
+                # and its KV cache are built only once some model actually matches it
+                if self._vocab_signature(model_path) != self._draft_vocab:
+                    return None
+                # One draft instance (and KV cache) serves every large model
+                if self._draft is None:
+                    draft = self._llama_class()(model_path=self.model_paths[draft_name], **llama_params())
+                    self._draft = DraftModel(draft, n_draft=5)
+                return self._draft
+        except Exception as e:
+            # A broken draft must not stop the large model from loading, it just decodes without one
+            print(f"Draft model {draft_name} unavailable ({str(e)}), loading without speculative decoding")
+            return None
+    
+    def _preload(self, model_name: str) -> Dict:
+        """Construct a model with mmap'd weights and register it in self.models"""
+        # Paths were resolved and checked when the directory was scanned
+        model_path = self.model_paths.get(model_name)
+        if model_path is None:
+            raise FileNotFoundError(f"Model file not found in {self.models_dir}")
+        
+        if model_name in self.bitnet_models:
+            # Initialize BitNet model
+            # Keep the model resident in-process so each turn skips the
+            # interpreter spawn and the full GGUF reload
+            if self._bitnet_backend is None:
+                self._bitnet_backend = self._llama_class()
+            try:
+                model = self._bitnet_backend(model_path=model_path, **llama_params())
+            except Exception as e:
+                # Stock llama-cpp-python wheels cannot read BitNet quants;
+                # fall back to the BitNet CLI until built with -DGGML_BITNET=ON
+                print(f"In-process BitNet backend unavailable ({str(e)}), using BitNet CLI")
+                model = None
+            
+            model_info = {
+                "type": "bitnet",
+                "model": model,
+                "path": model_path
+            }
+        else:
+            # Large models decode with a small draft model proposing tokens. It must be
+            # passed to the constructor, which then keeps logits for every drafted position
+            draft_model = None
+            if not DRAFT_PATTERN.search(model_name) and self.draft_candidates:
+                draft_model = self._draft_for(model_path)
+            
+            # Initialize regular LLM model
+            model_info = {
+                "type": "llama",
+                "model": self._llama_class()(model_path=model_path, draft_model=draft_model, **llama_params())
+            }
+            if draft_model is not None:
+                self.draft_models[model_name] = draft_model
+                print(f"Using {self.draft_candidates[0]} as draft model for {model_name}")
+        
+        # The system prompt never changes, so tokenize and prefill it once per model
+        # here rather than on the first turn's latency-critical path
+        if model_info["model"] is not None:
+            model = model_info["model"]
+            system_block = self._build_context(model_name, history=False)
+            self.system_tokens[model_name] = model.tokenize(
+                system_block.encode("utf-8"), add_bos=True, special=True
+            )
+            model.eval(self.system_tokens[model_name])
+            self.primed_state[model_name] = model.save_state()
+            self.eog_tokens[model_name] = end_of_generation_tokens(model)
+            self.turn_overhead[model_name] = {
+                role: len(model.tokenize(
+                    TURN_TEMPLATE.substitute(role=role, content="").encode("utf-8"),
+                    add_bos=False, special=True
+                ))
+                for role in ("user", "assistant")
+            }
+        
+        with self._models_lock:
+            self._schedulers.setdefault(model_name, BinScheduler())
+            self.models[model_name] = model_info
+        print(f"Preloaded model: {model_name} from {model_path}")
+        return model_info
     
     def load_model(self, model_name: str) -> str:
         """Load a specific model into memory"""
@@ -169,155 +359,307 @@ Always maintain a helpful and professional tone. If you're unsure about somethin
             return f"Model {model_name} not found!"
         
         try:
-            if model_name in self.bitnet_models:
-                # Initialize BitNet model
-                model_path = self.bitnet_models[model_name]
-                if not os.path.exists(model_path):
-                    return f"Error: BitNet model file not found at {model_path}"
-                
-                self.models[model_name] = {
-                    "type": "bitnet",
-                    "path": model_path
-                }
-                print(f"Loaded BitNet model: {model_name} from {model_path}")
-                return f"BitNet model {model_name} loaded successfully!"
-            else:
-                # Initialize regular LLM model
-                model_path = os.path.join(self.models_dir, model_name)
-                if not os.path.exists(model_path):
-                    return f"Error: Model file not found at {model_path}"
-                
-                self.models[model_name] = {
-                    "type": "llama",
-                    "model": Llama(
-                        model_path=model_path,
-                        n_ctx=2048,
-                        n_threads=4
-                    )
-                }
+            with self._models_lock:
+                future = self._preloads.get(model_name)
+                # A preload that hasn't started would sit behind every other pending one
+                # in the single-worker pool, so take it over and load in this thread
+                load_here = future is None or future.cancel()
+                if load_here:
+                    future = Future()
+                    future.set_running_or_notify_cancel()
+                    self._preloads[model_name] = future
+            
+            if load_here:
+                try:
+                    future.set_result(self._preload(model_name))
+                except Exception as e:
+                    future.set_exception(e)
+            
+            try:
+                model_info = future.result()
+            except Exception:
+                # Allow a retry on the next click
+                with self._models_lock:
+                    self._preloads.pop(model_name, None)
+                raise
+            
+            with self._schedulers[model_name].slot():
                 # Initialize conversation history for this model
                 self.conversation_history[model_name] = []
-                print(f"Loaded LLM model: {model_name} from {model_path}")
-                return f"Model {model_name} loaded successfully!"
+                self.kv_state.pop(model_name, None)
+                self.summary.pop(model_name, None)
+                self._evicted.pop(model_name, None)
+            
+            if model_info["type"] == "bitnet":
+                print(f"Loaded BitNet model: {model_name} from {model_info['path']}")
+                return f"BitNet model {model_name} loaded successfully!"
+            print(f"Loaded LLM model: {model_name}")
+            quant = parse_quant(model_name)
+            if quant in QUANT_BYTES_PER_PARAM:
+                return f"Model {model_name} loaded successfully! ({quant}, ~{QUANT_BYTES_PER_PARAM[quant]:.2f} bytes/param)"
+            return f"Model {model_name} loaded successfully!"
         except Exception as e:
             error_msg = f"Error loading model {model_name}: {str(e)}"
             print(error_msg)
             return error_msg
     
-    def generate_response(self, model_name: str, prompt: str) -> str:
-        """Generate response from the selected model"""
-        if not model_name:
-            return "Please select a model first!"
-            
-        if model_name not in self.models:
-            return "Please load the model first!"
+    def _history_budget(self, model_name: str) -> int:
+        """Tokens the history may use so the prompt and a reply still fit the context"""
+        model = self.models[model_name]["model"]
+        if model is None:
+            return self.max_history_tokens
+        reserve = min(self.max_new_tokens, model.n_ctx() // 2)
+        return model.n_ctx() - len(self.system_tokens[model_name]) - self.summary_tokens - reserve
+    
+    def _trim_history(self, model_name: str) -> None:
+        """Evict the oldest turns once the history outgrows the context budget"""
+        history = self.conversation_history[model_name]
+        model = self.models[model_name]["model"]
+        if model is None:
+            # The BitNet CLI has no tokenizer here, so estimate with words
+            size = lambda m: len(m["content"].split())
+        else:
+            # Content tokens plus the role tags around them
+            overhead = self.turn_overhead[model_name]
+            size = lambda m: (
+                len(model.tokenize(m["content"].encode("utf-8"), add_bos=False, special=True))
+                + overhead[m["role"]]
+            )
+        budget = self._history_budget(model_name)
+        used = sum(size(m) for m in history)
+        if used < budget:
+            return
         
-        try:
-            # Add the new user message to conversation history
-            if model_name not in self.conversation_history:
-                self.conversation_history[model_name] = []
-            self.conversation_history[model_name].append({"role": "user", "content": prompt})
-            
-            # Build the full conversation context
-            conversation_context = f"""<|system|>
-{self.system_prompt}
+        # Evict down to half the budget so the rebuilt KV cache is reused for
+        # several turns instead of being rebuilt on every one
+        evicted = self._evicted.setdefault(model_name, [])
+        while len(history) > 1 and used >= budget // 2:
+            message = history.pop(0)
+            used -= size(message)
+            evicted.append(message)
+        self.kv_state.pop(model_name, None)
+        
+        if model is None:
+            # No summary can be produced through the BitNet CLI, so drop the turns
+            evicted.clear()
+        elif len(evicted) >= self.summary_every:
+            # Fold the evicted turns into the running summary
+            self.summary[model_name] = self._summarize(model, model_name, evicted)
+            evicted.clear()
+    
+    def _summarize(self, model, model_name: str, messages: List[Dict[str, str]]) -> str:
+        """Summarize messages together with the previous summary using a short completion"""
+        transcript = "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in messages)
+        summary_prompt = f"""<|system|>
+Summarize the conversation below in a few sentences, keeping any facts needed to continue it.
 </|system|>
-"""
-            # Add conversation history
-            for message in self.conversation_history[model_name]:
-                if message["role"] == "user":
-                    conversation_context += f"""<|user|>
-{message['content']}
+<|user|>
+{self.summary.get(model_name, "")}
+{transcript}
 </|user|>
+<|assistant|>
 """
-                else:
-                    conversation_context += f"""<|assistant|>
-{message['content']}
-</|assistant|>
-"""
-            # Add the current assistant tag
-            conversation_context += "<|assistant|>\n"
-            
-            model_info = self.models[model_name]
+        response = model(
+            summary_prompt,
+            max_tokens=128,
+            temperature=0.3,
+            stop=["</|assistant|>", "<|user|>", "<|system|>"]
+        )
+        return response['choices'][0]['text'].strip()
+    
+    def _render_history(self, model_name: str) -> str:
+        """Render the model's history, formatting only the turns added since the last call"""
+        turns = tuple((m["role"], m["content"]) for m in self.conversation_history[model_name])
+        last_turns, last_text = self._rendered.get(model_name, ((), ""))
+        if turns[:len(last_turns)] == last_turns:
+            text = last_text + format_turns(turns[len(last_turns):])
+        else:
+            text = format_turns(turns)
+        self._rendered[model_name] = (turns, text)
+        return text
+    
+    def _build_context(self, model_name: str, system: bool = True, history: bool = True) -> str:
+        """Build the conversation prompt from the system prompt and/or the history"""
+        # Collect the pieces and join once, repeated += copies the prompt every turn
+        parts = []
+        if system:
+            parts.append(f"<|system|>\n{self.system_prompt}\n</|system|>\n")
+        if not history:
+            return "".join(parts)
+        
+        # Add the summary of turns that no longer fit in the history window
+        if self.summary.get(model_name):
+            parts.append(f"<|system|>\nSummary of the earlier conversation:\n{self.summary[model_name]}\n</|system|>\n")
+        # Add conversation history
+        parts.append(self._render_history(model_name))
+        # Add the current assistant tag
+        parts.append("<|assistant|>\n")
+        return "".join(parts)
+    
+    def generate_response(self, model_name: str, prompt: str) -> Iterator[str]:
+        """Stream the response from the selected model, yielding the text so far"""
+        if not model_name:
+            yield "Please select a model first!"
+            return
             
-            if model_info["type"] == "bitnet":
-                # Run BitNet inference with enhanced error handling
-                try:
-                    # Verify llama-cli exists
-                    llama_cli_path = os.path.join("BitNet", "llama-cli")
-                    if not os.path.exists(llama_cli_path):
-                        return "Error: llama-cli not found. Please run setup_bitnet.sh first."
-                    
-                    # Verify run_inference.py exists
-                    run_inference_path = os.path.join("BitNet", "run_inference.py")
-                    if not os.path.exists(run_inference_path):
-                        return "Error: run_inference.py not found. Please run setup_bitnet.sh first."
-                    
-                    # Run inference with full path to Python
-                    python_path = sys.executable
-                    cmd = [
-                        python_path,
-                        run_inference_path,
-                        "-m", model_info["path"],
-                        "-p", conversation_context,
-                        "-cnv",
-                        "-t", "4",  # Use 4 threads
-                        "-c", "2048",  # Context size
-                        "-temp", "0.7"  # Temperature
-                    ]
-                    
-                    print(f"Running BitNet command: {' '.join(cmd)}")  # Debug output
-                    
-                    # Set the working directory to the current directory
-                    result = subprocess.run(
-                        cmd,
-                        capture_output=True,
-                        text=True,
-                        cwd=os.getcwd()  # Use current working directory
-                    )
+        if model_name not in self.models:
+            yield "Please load the model first!"
+            return
+        
+        # One generation at a time per model, concurrent turns would corrupt its KV cache.
+        # Waiting requests are admitted shortest predicted bin first.
+        with self._schedulers[model_name].slot(prompt):
+            try:
+                # Add the new user message to conversation history
+                if model_name not in self.conversation_history:
+                    self.conversation_history[model_name] = []
+                self.conversation_history[model_name].append({"role": "user", "content": prompt})
+                self._trim_history(model_name)
+                
+                model_info = self.models[model_name]
+                
+                if model_info["type"] == "bitnet" and model_info["model"] is None:
+                    # The CLI is stateless, so it always needs the full conversation
+                    conversation_context = self._build_context(model_name)
                     
-                    if result.returncode != 0:
-                        error_msg = f"BitNet inference error (code {result.returncode}):\n"
-                        error_msg += f"STDOUT: {result.stdout}\n"
-                        error_msg += f"STDERR: {result.stderr}"
+                    # Run BitNet CLI inference with enhanced error handling
+                    try:
+                        # Verify llama-cli exists
+                        llama_cli_path = os.path.join("BitNet", "llama-cli")
+                        if not os.path.exists(llama_cli_path):
+                            yield "Error: llama-cli not found. Please run setup_bitnet.sh first."
+                            return
+                        
+                        # Verify run_inference.py exists
+                        run_inference_path = os.path.join("BitNet", "run_inference.py")
+                        if not os.path.exists(run_inference_path):
+                            yield "Error: run_inference.py not found. Please run setup_bitnet.sh first."
+                            return
+                        
+                        # Run inference with full path to Python
+                        python_path = sys.executable
+                        cmd = [
+                            python_path,
+                            run_inference_path,
+                            "-m", model_info["path"],
+                            "-p", conversation_context,
+                            "-cnv",
+                            "-t", "4",  # Use 4 threads
+                            "-c", "2048",  # Context size
+                            "-temp", "0.7"  # Temperature
+                        ]
+                        
+                        print(f"Running BitNet command: {' '.join(cmd)}")  # Debug output
+                        
+                        # Stream stdout as it is produced; stderr goes to a temp file so a
+                        # chatty llama-cli cannot fill its pipe and stall the child
+                        with tempfile.TemporaryFile() as stderr_file:
+                            with subprocess.Popen(
+                                cmd,
+                                stdout=subprocess.PIPE,
+                                stderr=stderr_file,
+                                cwd=os.getcwd()  # Use current working directory
+                            ) as proc:
+                                # Decode raw bytes in one UTF-8 pass; a character split across
+                                # reads or an invalid byte must not discard the completion
+                                decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+                                stdout_text = ""
+                                try:
+                                    for line in proc.stdout:
+                                        stdout_text += decoder.decode(line)
+                                        yield stdout_text.strip()
+                                    stdout_text += decoder.decode(b"", final=True)
+                                    proc.wait()
+                                finally:
+                                    # Stop the child if the user cancelled mid-reply
+                                    if proc.poll() is None:
+                                        proc.kill()
+                            stderr_file.seek(0)
+                            stderr_text = stderr_file.read().decode("utf-8", errors="replace")
+                        
+                        if proc.returncode != 0:
+                            error_msg = f"BitNet inference error (code {proc.returncode}):\n"
+                            error_msg += f"STDOUT: {stdout_text}\n"
+                            error_msg += f"STDERR: {stderr_text}"
+                            print(error_msg)  # Debug output
+                            yield error_msg
+                            return
+                        
+                        response_text = stdout_text.strip()
+                        if not response_text:
+                            yield "Error: BitNet returned empty response"
+                            return
+                        
+                        # Add the assistant's response to conversation history
+                        self.conversation_history[model_name].append({"role": "assistant", "content": response_text})
+                        
+                        yield response_text
+                        
+                    except Exception as e:
+                        error_msg = f"Error running BitNet inference: {str(e)}\n"
+                        error_msg += f"Python path: {python_path}\n"
+                        error_msg += f"Model path: {model_info['path']}"
                         print(error_msg)  # Debug output
-                        return error_msg
+                        yield error_msg
+                else:
+                    model = model_info["model"]
+                    if model_name in self.kv_state:
+                        # Resume the cached session and prefill only the new user turn
+                        model.load_state(self.kv_state[model_name])
+                        turn = f"<|user|>\n{prompt}\n</|user|>\n<|assistant|>\n"
+                        tokens = model.tokenize(turn.encode("utf-8"), add_bos=False, special=True)
+                    else:
+                        # Start a new session from the checkpoint with the system block already evaluated
+                        model.load_state(self.primed_state[model_name])
+                        conversation_context = self._build_context(model_name, system=False)
+                        tokens = model.tokenize(conversation_context.encode("utf-8"), add_bos=False, special=True)
+                    prompt_end = model.n_tokens + len(tokens)
+                    # Leave room in the context for the prompt and the closing tag evaluated after the reply
+                    closing_tokens = len(model.tokenize(b"\n</|assistant|>\n", add_bos=False, special=True))
+                    max_tokens = min(self.max_new_tokens, model.n_ctx() - prompt_end - closing_tokens)
+                    if max_tokens <= 0:
+                        raise ValueError(f"Prompt of {prompt_end} tokens does not fit the {model.n_ctx()}-token context")
                     
-                    response_text = result.stdout.strip()
-                    if not response_text:
-                        return "Error: BitNet returned empty response"
+                    # Sample token by token so the KV cache stays on this session
+                    eog_tokens = self.eog_tokens[model_name]
+                    stop = ["</|assistant|>", "<|user|>", "<|system|>"]
+                    completion_bytes = b""
+                    response_text = ""
+                    for n_generated, token in enumerate(model.generate(tokens, temp=0.7, top_p=0.9, reset=False)):
+                        if token in eog_tokens or n_generated >= max_tokens:
+                            break
+                        completion_bytes += model.detokenize([token])
+                        response_text = completion_bytes.decode("utf-8", errors="ignore")
+                        stop_at = min((response_text.find(s) for s in stop if s in response_text), default=-1)
+                        if stop_at != -1:
+                            response_text = response_text[:stop_at]
+                            break
+                        # Hold back a partial stop tag so it never flashes in the UI
+                        held = max((k for s in stop for k in range(1, len(s)) if response_text.endswith(s[:k])), default=0)
+                        yield response_text[:len(response_text) - held].strip()
+                    response_text = response_text.strip()
+                    
+                    # Rewind past the raw sampled tokens and close the turn exactly as
+                    # _build_context would, then checkpoint the session for the next turn
+                    model.n_tokens = prompt_end
+                    closing = f"{response_text}\n</|assistant|>\n"
+                    model.eval(model.tokenize(closing.encode("utf-8"), add_bos=False, special=True))
+                    self.kv_state[model_name] = model.save_state()
                     
                     # Add the assistant's response to conversation history
                     self.conversation_history[model_name].append({"role": "assistant", "content": response_text})
                     
-                    return response_text
-                    
-                except Exception as e:
-                    error_msg = f"Error running BitNet inference: {str(e)}\n"
-                    error_msg += f"Python path: {python_path}\n"
-                    error_msg += f"Model path: {model_info['path']}"
-                    print(error_msg)  # Debug output
-                    return error_msg
-            else:
-                # Generate response with proper formatting
-                response = model_info["model"](
-                    conversation_context,
-                    max_tokens=2000,
-                    temperature=0.7,
-                    top_p=0.9,
-                    stop=["</|assistant|>", "<|user|>", "<|system|>"]
-                )
-                response_text = response['choices'][0]['text'].strip()
-                response_text = response_text.replace("</|assistant|>", "").strip()
-                
-                # Add the assistant's response to conversation history
-                self.conversation_history[model_name].append({"role": "assistant", "content": response_text})
-                
-                return response_text
-        except Exception as e:
-            error_msg = f"Error generating response: {str(e)}"
-            print(error_msg)  # Debug output
-            return error_msg
+                    yield response_text
+            except GeneratorExit:
+                # Cancelled mid-reply, so the cached session is incomplete
+                self.kv_state.pop(model_name, None)
+                raise
+            except Exception as e:
+                # The cached session no longer matches the history, rebuild it next turn
+                self.kv_state.pop(model_name, None)
+                error_msg = f"Error generating response: {str(e)}"
+                print(error_msg)  # Debug output
+                yield error_msg
 
 def create_interface():
     insta_llm = InstaLLM()
@@ -325,7 +667,7 @@ def create_interface():
     with gr.Blocks(
         title="InstaLLM by HANYA.inc",
         theme=gr.themes.Soft(primary_hue="blue"),
-        css=custom_css
+        css=(Path(__file__).parent / "static" / "custom.css").read_text()
     ) as interface:
         with gr.Row():
             with gr.Column(scale=1, elem_classes="title-container"):
@@ -338,11 +680,13 @@ def create_interface():
         
         with gr.Row():
             with gr.Column(scale=1):
+                # Choices are ordered fastest quantization first
+                model_choices = insta_llm._load_available_models()
                 model_dropdown = gr.Dropdown(
-                    choices=insta_llm._load_available_models(),
+                    choices=model_choices,
                     label="Select Model",
                     interactive=True,
-                    value=insta_llm.available_models[0] if insta_llm.available_models else None,
+                    value=model_choices[0] if model_choices else None,
                     allow_custom_value=False
                 )
                 load_button = gr.Button("Load Model", variant="primary")
@@ -378,30 +722,65 @@ def create_interface():
             return insta_llm.load_model(model_name)
         
         def generate_response(model_name, prompt):
-            return insta_llm.generate_response(model_name, prompt)
+            yield from insta_llm.generate_response(model_name, prompt)
         
         load_button.click(
             fn=load_selected_model,
             inputs=[model_dropdown],
-            outputs=[load_status]
+            outputs=[load_status],
+            concurrency_limit=1
         )
         
         generate_button.click(
             fn=generate_response,
             inputs=[model_dropdown, chat_input],
-            outputs=[response_output]
+            outputs=[response_output],
+            queue=True,
+            # Let waiting turns reach the per-model scheduler, which runs them one at a time
+            concurrency_limit=4
         )
         
         # Auto-refresh model list
         interface.load(update_model_list, None, [model_dropdown])
     
+    # Generator handlers stream through the queue, which also keeps concurrent
+    # users from oversubscribing the CPU cores llama.cpp is already using
+    interface.queue(default_concurrency_limit=1, max_size=32)
     return interface
 
-if __name__ == "__main__":
+def create_app():
+    """ASGI app factory, so uvicorn can run one worker process with its own model pool per CPU socket"""
+    import anyio
+    from contextlib import asynccontextmanager
+    from fastapi import FastAPI
+    
     interface = create_interface()
-    interface.launch(
-        share=True,
-        server_name="0.0.0.0",
-        server_port=7860,
-        show_error=True
-    ) 
\ No newline at end of file
+    # launch(show_error=True) used to surface handler errors in the UI, keep that when mounted
+    interface.show_error = True
+    app = gr.mount_gradio_app(FastAPI(), interface, path="/")
+    
+    # Wrap whatever lifespan Gradio installed (startup handlers or a chained lifespan, depending
+    # on the version) rather than replacing it, so its queue is still started
+    gradio_lifespan = app.router.lifespan_context
+    
+    @asynccontextmanager
+    async def lifespan(app):
+        # Sync handlers run in anyio's threadpool (40 threads by default) while llama.cpp releases the GIL
+        anyio.to_thread.current_default_thread_limiter().total_tokens = 128
+        async with gradio_lifespan(app) as state:
+            yield state
+    
+    app.router.lifespan_context = lifespan
+    return app
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "app:create_app",
+        factory=True,
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host="0.0.0.0",
+        port=7860,
+        # Each worker keeps its own queue and chat state, see README before raising this
+        workers=int(os.getenv("WORKERS", 1))
+    )
@@ -118,14 +118,14 @@ install_python_dependencies() {
     # Install llama-cpp-python with OpenMP support
     if ! python_package_installed "llama-cpp-python"; then
         echo "Installing llama-cpp-python from source with OpenMP support..."
-        CMAKE_ARGS="-DLLAMA_OPENMP=ON -DCMAKE_SHARED_LINKER_FLAGS='-Wl,-rpath,/usr/lib'" pip install llama-cpp-python>=0.2.6 --no-cache-dir
+        CMAKE_ARGS="-DLLAMA_OPENMP=ON -DCMAKE_SHARED_LINKER_FLAGS='-Wl,-rpath,/usr/lib'" pip install "llama-cpp-python>=0.2.62" --no-cache-dir
     else
         echo "llama-cpp-python is already installed."
     fi
     
     # Install Gradio and other required packages
     echo "Installing Gradio and other dependencies..."
-    pip install gradio>=4.0.0
+    pip install "gradio>=4.44.0"
     pip install typing-extensions
     pip install requests
     pip install numpy